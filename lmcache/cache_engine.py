@@ -1,9 +1,11 @@
-import hashlib
 import logging
 import time
+from collections import OrderedDict
 from typing import Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
+from blake3 import blake3
 
 from lmcache.config import LMCacheEngineConfig, LMCacheEngineMetadata
 from lmcache.logging import init_logger
@@ -12,6 +14,15 @@ from lmcache.utils import CacheEngineKey, KVCache, _lmcache_nvtx_annotate
 
 logger = init_logger(__name__)
 
+# Max number of token sequences whose prefix hashes are remembered
+_HASH_MEMO_SIZE = 32
+
+# The token dimension of the kv blob for each kv format
+_BLOB_TOKEN_DIM = {
+    "vllm": 2,
+    "huggingface": 3,
+}
+
 
 class LMCacheEngine:
 
@@ -24,6 +35,7 @@ class LMCacheEngine:
         Throws:
             RuntimeError if the loaded configuration does not match the current
             configuration
+            ValueError if the kv format in the metadata is invalid
         """
 
         self.config = config
@@ -31,68 +43,125 @@ class LMCacheEngine:
         self.chunk_size = config.chunk_size
         self.save_decode_cache = config.save_decode_cache
 
+        # The kv format is fixed for an engine, so the token dimension is
+        # resolved once here instead of dispatching on the format per call
+        if metadata.fmt not in _BLOB_TOKEN_DIM:
+            raise ValueError(f"Invalid format: {metadata.fmt}")
+        self._blob_token_dim = _BLOB_TOKEN_DIM[metadata.fmt]
+        # the same dimension in the per-layer k/v tensors
+        self._kv_token_dim = self._blob_token_dim - 2
+
         self.engine_ = CreateStorageBackend(config, metadata)
         logger.debug(f"Current storage backend type {type(self.engine_)}")
 
-    def _make_key(self, chunk_hash: str, fmt: str) -> CacheEngineKey:
+        # If the chunks only live in local cpu memory, blocking stores move
+        # the kv cache to cpu with one transfer before chunking, rather than
+        # one transfer per chunk in the backend. Not with a local store
+        # dtype, which is applied before the transfer to make it smaller,
+        # nor with pinned memory, where the backend copies each chunk
+        # straight into a pinned buffer.
+        self._store_device: Optional[str] = None
+        if (config.local_device == "cpu" and config.remote_url is None
+                and config.local_store_dtype is None
+                and not config.local_pin_memory):
+            self._store_device = "cpu"
+
+        # first chunk hash -> (tokens, prefix hashes) of recent sequences,
+        # in LRU order. Lets repeated store/retrieve calls on a growing
+        # sequence only hash the new chunks.
+        self._hash_memo: OrderedDict[bytes,
+                                     Tuple[np.ndarray,
+                                           List[bytes]]] = OrderedDict()
+
+    def _make_key(self, chunk_hash: bytes, fmt: str) -> CacheEngineKey:
         return CacheEngineKey(
             fmt,
             self.metadata.model_name,
             self.metadata.world_size,
             self.metadata.worker_id,
-            chunk_hash,
+            chunk_hash.hex(),
         )
 
-    def _num_tokens_in_kv(self, kv_tensors: Union[KVCache, torch.Tensor],
-                          fmt: str) -> int:
-        if fmt == "huggingface":
-            return kv_tensors[0][0].shape[1]
-        elif fmt == "vllm":
-            return kv_tensors[0][0].shape[0]
-        else:
-            raise ValueError(f"Invalid format: {fmt}")
+    def _num_tokens_in_kv(self, kv_tensors: Union[KVCache,
+                                                  torch.Tensor]) -> int:
+        return kv_tensors[0][0].shape[self._kv_token_dim]
 
-    def _get_init_hash(self) -> str:
-        return ""
+    def _get_init_hash(self) -> bytes:
+        return b""
 
     def _hash(
         self,
-        tokens: torch.Tensor,
-        prefix_hash: str,
-    ) -> str:
-        # TODO: change it to a more efficient hash function
-        return hashlib.sha256(
-            prefix_hash.encode("ascii") +
-            tokens.cpu().numpy().tobytes()).hexdigest()
-
-    def _chunk_tokens(
+        token_bytes: memoryview,
+        prefix_hash: bytes,
+    ) -> bytes:
+        # NOTE: the chunk hash is only used as a cache key, so a 128-bit
+        # BLAKE3 digest is enough and much cheaper than SHA-256.
+        # A single one-shot call is cheaper than an incremental hasher
+        # for chunk-sized inputs, even with the small concatenation.
+        return blake3(prefix_hash + token_bytes).digest(length=16)
+
+    def _prefix_hash(
         self,
         tokens: torch.Tensor,
-    ) -> Iterable[torch.Tensor]:
+        num_skip_chunk: Optional[int] = 0,
+    ) -> List[bytes]:
         """
-        Chunk the tokens into chunks of size self.chunk_size.
+        Compute the chained prefix hash of every chunk of the tokens.
 
         Input:
             tokens: the input tokens, with shape [seq_len]
-            device: the target device after chunking
+            num_skip_chunk: the number of leading chunk hashes to drop
 
         Output:
-            a generator of chunks of tokens, each with shape [chunk_size]
+            a list of prefix hashes, one per chunk of size self.chunk_size
         """
-        # TODO(Jiayi): the following step can be parallelized
-        for i in range(0, len(tokens), self.chunk_size):
-            yield tokens[i:i + self.chunk_size]
-
-    def _prefix_hash(
-        self,
-        token_chunks: Iterable[torch.Tensor],
-        num_skip_chunk: Optional[int] = 0,
-    ) -> List[str]:
-        prefix_hash = self._get_init_hash()
-        prefix_hashes = []
-        for token_chunk in token_chunks:
-            prefix_hash = self._hash(token_chunk, prefix_hash)
+        # Move the tokens to cpu once and hash slices of a single byte
+        # view of them, instead of creating a tensor or array per chunk
+        token_array = tokens.detach().cpu().contiguous().numpy()
+        token_bytes = token_array.data.cast("B")
+        chunk_nbytes = self.chunk_size * token_array.itemsize
+        num_tokens = len(token_array)
+        if num_tokens == 0:
+            return []
+
+        first_hash = self._hash(token_bytes[:chunk_nbytes],
+                                self._get_init_hash())
+        prefix_hashes = [first_hash]
+        memo = self._hash_memo.get(first_hash)
+        if memo is not None:
+            memo_tokens, memo_hashes = memo
+            # Hashes of the chunks that are identical to the remembered
+            # sequence can be reused without hashing them again
+            n = min(num_tokens, len(memo_tokens))
+            mismatch = np.flatnonzero(token_array[:n] != memo_tokens[:n])
+            num_common = int(mismatch[0]) if len(mismatch) > 0 else n
+            if num_common == num_tokens == len(memo_tokens):
+                prefix_hashes = memo_hashes[:]
+            else:
+                num_reused = max(num_common // self.chunk_size, 1)
+                prefix_hashes = memo_hashes[:num_reused]
+
+        num_reused = len(prefix_hashes)
+        prefix_hash = prefix_hashes[-1]
+        # NOTE: this loop is intentionally sequential. Hashing a 256-token
+        # chunk takes ~2us, while storing or retrieving its kv cache moves
+        # tens of MB (~1ms even over PCIe). So hashing the chunks in
+        # parallel could save at most ~0.2% of a store/retrieve, with any
+        # number of cores.
+        for i in range(num_reused * chunk_nbytes, len(token_bytes),
+                       chunk_nbytes):
+            prefix_hash = self._hash(token_bytes[i:i + chunk_nbytes],
+                                     prefix_hash)
             prefix_hashes.append(prefix_hash)
+
+        if memo is None or len(prefix_hashes) > num_reused:
+            # copy the tokens since the caller may reuse the tensor
+            self._hash_memo[first_hash] = (token_array.copy(),
+                                           prefix_hashes[:])
+        self._hash_memo.move_to_end(first_hash)
+        if len(self._hash_memo) > _HASH_MEMO_SIZE:
+            self._hash_memo.popitem(last=False)
+
         return prefix_hashes[num_skip_chunk:]
 
     def _tuple_kv_to_blob(
@@ -103,19 +172,12 @@ class LMCacheEngine:
         Convert the nested tuple of kv tensors to a single big tensor with 2
         extra dimensions
         """
-        k_temp = []
-        v_temp = []
-        for kv_layer in kv_tensors:
-            k_temp.append(kv_layer[0])
-            v_temp.append(kv_layer[1])
-        k_tensor_blob = torch.stack(k_temp)
-        v_tensor_blob = torch.stack(v_temp)
-
-        # kv_tensors: [num_layer, 2, num_tok, num_kv_head, head_size]
-        kv_tensors_flatten = torch.stack((k_tensor_blob, v_tensor_blob))
-        kv_tensors_flatten = kv_tensors_flatten.permute([1, 0, 2, 3, 4])
-
-        return kv_tensors_flatten
+        # A single stack over the flattened (k, v) list builds the
+        # [num_layer, 2, ...] blob with one contiguous copy
+        num_layers = len(kv_tensors)
+        kv_blob = torch.stack(
+            [tensor for kv_layer in kv_tensors for tensor in kv_layer])
+        return kv_blob.view(num_layers, 2, *kv_blob.shape[1:])
 
     def _blob_to_tuple_kv(
         self,
@@ -132,38 +194,30 @@ class LMCacheEngine:
         self,
         start_idx: int,
         kv_tensors: torch.Tensor,
-        fmt: str,
+        device: Optional[str] = None,
     ) -> List[torch.Tensor]:
         """
         vllm format: [num_layer, 2, num_tokens, num_kv_head, head_size]
         huggingface format: [num_layer, 2, num_kv_head, num_tokens, head_size]
+
+        If device is given, the kv cache after start_idx is moved to it with
+        a single transfer before being split into chunks.
         """
-        match fmt:
-            case "vllm":
-                return [
-                    x.contiguous() for x in list(
-                        torch.split(
-                            kv_tensors[:, :, start_idx:, ...],
-                            self.chunk_size,
-                            dim=2,
-                        ))
-                ]
-            case "huggingface":
-                return [
-                    x.contiguous() for x in list(
-                        torch.split(
-                            kv_tensors[:, :, :, start_idx:, ...],
-                            self.chunk_size,
-                            dim=3,
-                        ))
-                ]
-            case _:
-                raise ValueError(f"Invalid format: {fmt}")
+        token_dim = self._blob_token_dim
+        # one view + one split over all layers
+        kv_suffix = kv_tensors.narrow(token_dim, start_idx,
+                                      kv_tensors.shape[token_dim] - start_idx)
+        if device is not None:
+            kv_suffix = kv_suffix.to(device)
+        return [
+            x.contiguous()
+            for x in kv_suffix.split(self.chunk_size, dim=token_dim)
+        ]
 
     def _chunk_kv(
         self,
         kv_tensors: torch.Tensor,
-        fmt: str,
+        device: Optional[str] = None,
     ) -> Iterable[torch.Tensor]:
         """
         Chunk the kv cache into chunks of size self.chunk_size.
@@ -172,40 +226,72 @@ class LMCacheEngine:
             tokens: the input tokens, with shape [seq_len]
             kv_tensors: the kv cache of the tokens, in the format of nested 
             tuples
-            fmt: either 'huggingface' or 'vllm'
 
         Output:
             a generator of tuples, each tuple is a chunk of tokens and the 
             corresponding kv cache.
         """
-        return self._slice_kv_at(0, kv_tensors, fmt)
+        return self._slice_kv_at(0, kv_tensors, device)
+
+    def _concat_kv_chunks(
+        self,
+        kv_chunks: List[torch.Tensor],
+        start_idx: int,
+    ) -> torch.Tensor:
+        """
+        Concatenate the kv chunks along the token dimension, dropping the
+        first start_idx tokens of the first chunk.
+
+        The output is allocated once and every chunk is copied into its slot,
+        so no intermediate tensors are created. The output has the device and
+        dtype of the first chunk, the chunks are expected to match it.
+        """
+        token_dim = self._blob_token_dim
+        chunk_lens = [chunk.shape[token_dim] for chunk in kv_chunks]
+        chunk_lens[0] -= start_idx
+
+        out_shape = list(kv_chunks[0].shape)
+        out_shape[token_dim] = sum(chunk_lens)
+        out = torch.empty(out_shape,
+                          dtype=kv_chunks[0].dtype,
+                          device=kv_chunks[0].device)
+
+        offset = 0
+        for idx, (chunk, chunk_len) in enumerate(zip(kv_chunks, chunk_lens)):
+            if idx == 0:
+                chunk = chunk.narrow(token_dim, start_idx, chunk_len)
+            out.narrow(token_dim, offset, chunk_len).copy_(chunk,
+                                                           non_blocking=True)
+            offset += chunk_len
+        return out
 
     def _make_chunks_skip_existing(
         self,
         tokens: torch.Tensor,
         kv_tensors: torch.Tensor,
         fmt: str,
-    ) -> Iterable[Tuple[str, torch.Tensor]]:
+        device: Optional[str] = None,
+    ) -> Tuple[List[bytes], Iterable[Tuple[bytes, torch.Tensor]]]:
         """
-        Skip the existing chunks and return the rest of the chunks
+        Skip the existing chunks and return their hashes and the rest of the
+        chunks
         """
-        chunk_hashes = self._prefix_hash(self._chunk_tokens(tokens))
-        num_tokens: int = self._num_tokens_in_kv(kv_tensors, fmt)
+        chunk_hashes = self._prefix_hash(tokens)
 
-        start_token_idx = None
+        # Check every chunk here: skipping over a hole left by eviction
+        # would never fill it again
         start_chunk_idx = 0
-        for chunk_hash, idx in zip(chunk_hashes,
-                                   range(0, num_tokens, self.chunk_size)):
+        for chunk_hash in chunk_hashes:
             if not self.engine_.contains(self._make_key(chunk_hash, fmt)):
-                start_token_idx = idx
                 break
             start_chunk_idx += 1
-
-        if start_token_idx is None:
-            return zip([], [])
-        chunk_kvs = self._slice_kv_at(start_token_idx, kv_tensors, fmt)
+        skipped_hashes = chunk_hashes[:start_chunk_idx]
+        if start_chunk_idx == len(chunk_hashes):
+            return skipped_hashes, zip([], [])
+        start_token_idx = start_chunk_idx * self.chunk_size
+        chunk_kvs = self._slice_kv_at(start_token_idx, kv_tensors, device)
         chunk_hashes = chunk_hashes[start_chunk_idx:]
-        return zip(chunk_hashes, chunk_kvs)
+        return skipped_hashes, zip(chunk_hashes, chunk_kvs)
 
     def _make_chunks(
         self,
@@ -213,16 +299,21 @@ class LMCacheEngine:
         kv_tensors: torch.Tensor,
         fmt: str,
         skip_existing=True,
-    ) -> Iterable[Tuple[str, torch.Tensor]]:
+        device: Optional[str] = None,
+    ) -> Tuple[List[bytes], Iterable[Tuple[bytes, torch.Tensor]]]:
         """
-        Returns a generator of zipped (chunk_hash, chunk_kv) tuples
+        Returns the hashes of the skipped existing chunks, and a generator
+        of zipped (chunk_hash, chunk_kv) tuples of the rest
+
+        If device is given, the chunks are moved to it.
         """
         if skip_existing:
-            return self._make_chunks_skip_existing(tokens, kv_tensors, fmt)
+            return self._make_chunks_skip_existing(tokens, kv_tensors, fmt,
+                                                   device)
         else:
-            return zip(
-                self._prefix_hash(self._chunk_tokens(tokens)),
-                self._chunk_kv(kv_tensors, fmt),
+            return [], zip(
+                self._prefix_hash(tokens),
+                self._chunk_kv(kv_tensors, device),
             )
 
     @_lmcache_nvtx_annotate
@@ -262,15 +353,19 @@ class LMCacheEngine:
             tokens.shape) == 1), f"Invalid shape of tokens: {tokens.shape}"
         assert len(kv_tensors_raw) > 0, "Empty kv_tensors"
         assert len(tokens) == self._num_tokens_in_kv(
-            kv_tensors_raw, fmt
+            kv_tensors_raw
         ), "Number of tokens in the kv cache does not match the input tokens"
 
         kv_tensors = self._tuple_kv_to_blob(kv_tensors_raw)
         """ chunk the tokens and the kv caches """
-        chunk_hashes_and_kvs = self._make_chunks(tokens,
-                                                 kv_tensors,
-                                                 fmt,
-                                                 skip_existing=skip_existing)
+        # A non-blocking store leaves the copy to the backend's put thread
+        store_device = self._store_device if blocking else None
+        skipped_hashes, chunk_hashes_and_kvs = self._make_chunks(
+            tokens,
+            kv_tensors,
+            fmt,
+            skip_existing=skip_existing,
+            device=store_device)
         if not blocking:
             chunk_hashes_and_kvs = list(chunk_hashes_and_kvs)
         end_make_chunks = time.perf_counter()
@@ -279,6 +374,12 @@ class LMCacheEngine:
             ((self._make_key(chunk_hash, fmt), kv_chunk)
              for chunk_hash, kv_chunk in chunk_hashes_and_kvs),
             blocking=blocking,
+            # the skipped chunks are the head of the same prefix, the
+            # backend must not evict them to make room for the rest
+            prefix_keys=[
+                self._make_key(chunk_hash, fmt)
+                for chunk_hash in skipped_hashes
+            ],
         )
 
         end_time = time.perf_counter()
@@ -330,8 +431,7 @@ class LMCacheEngine:
 
         st = time.perf_counter()
         fmt = self.metadata.fmt
-        chunk_hashes = self._prefix_hash(self._chunk_tokens(tokens),
-                                         num_skip_chunk)
+        chunk_hashes = self._prefix_hash(tokens, num_skip_chunk)
 
         retrival_iterator = self.engine_.batched_get(
             (self._make_key(chunk_hash, fmt) for chunk_hash in chunk_hashes), )
@@ -342,15 +442,6 @@ class LMCacheEngine:
                 break
             retrieved_kv_chunks.append(chunk)
         """ concatenate the kv cache """
-        dim = None
-        match fmt:
-            case "huggingface":
-                dim = 1
-            case "vllm":
-                dim = 0
-            case _:
-                raise ValueError(f"Invalid format: {fmt}")
-
         if len(retrieved_kv_chunks) == 0:
             logging.info("Retrieved 0 chunks")
             ret_mask[:] = False
@@ -359,18 +450,14 @@ class LMCacheEngine:
         st2 = time.perf_counter()
 
         # drop extra tokens in the first chunk
-        extra_token_len = num_skip_tok - num_skip_chunk * self.chunk_size
-        retrieved_kv_chunks[0] = self._slice_kv_at(extra_token_len,
-                                                   retrieved_kv_chunks[0],
-                                                   fmt)[0]
-
+        extra_token_len = int(num_skip_tok - num_skip_chunk * self.chunk_size)
         ret = self._blob_to_tuple_kv(
-            torch.cat(retrieved_kv_chunks, dim=dim + 2))
+            self._concat_kv_chunks(retrieved_kv_chunks, extra_token_len))
         ed2 = time.perf_counter()
         logger.info(
             f"Concatenated {len(retrieved_kv_chunks)} chunks -- elapsed time"
             f"{ed2 - st2}")
-        retrieved_token_count = 0 if len(ret) == 0 else ret[0][0].shape[dim]
+        retrieved_token_count = self._num_tokens_in_kv(ret)
         ed = time.perf_counter()
         logger.info(f"Retrieved {len(retrieved_kv_chunks)} chunks "
                     f"({retrieved_token_count} tokens in total) --"
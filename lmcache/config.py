@@ -30,6 +30,18 @@ class LMCacheEngineConfig:
 
     save_decode_cache: bool  # whether to store decode kv cache
 
+    # max number of chunks kept by the local backend, None means unbounded
+    max_local_chunks: Optional[int] = None
+
+    # dtype of the chunks in the local backend, can be "float16", "bfloat16"
+    # or "int8" (lossy). None keeps the original dtype
+    local_store_dtype: Optional[str] = None
+
+    # whether the local cpu backend keeps the chunks in pinned memory, which
+    # makes the copies to gpu asynchronous. Pinned memory cannot be swapped
+    # out, so consider bounding it with max_local_chunks
+    local_pin_memory: bool = False
+
     @staticmethod
     def from_defaults(
         chunk_size: int = 256,
@@ -38,6 +50,9 @@ class LMCacheEngineConfig:
         remote_serde: str = "torch",
         pipelined_backend: bool = False,
         save_decode_cache: bool = False,
+        max_local_chunks: Optional[int] = None,
+        local_store_dtype: Optional[str] = None,
+        local_pin_memory: bool = False,
     ) -> "LMCacheEngineConfig":
         return LMCacheEngineConfig(
             chunk_size,
@@ -46,6 +61,9 @@ class LMCacheEngineConfig:
             remote_serde,
             pipelined_backend,
             save_decode_cache,
+            max_local_chunks,
+            local_store_dtype,
+            local_pin_memory,
         )
 
     @staticmethod
@@ -56,6 +74,9 @@ class LMCacheEngineConfig:
         remote_serde: Optional[str] = "torch",
         pipelined_backend: bool = False,
         save_decode_cache: bool = False,
+        max_local_chunks: Optional[int] = None,
+        local_store_dtype: Optional[str] = None,
+        local_pin_memory: bool = False,
     ) -> "LMCacheEngineConfig":
 
         local_device: Optional[str] = None
@@ -79,6 +100,9 @@ class LMCacheEngineConfig:
             remote_serde,
             pipelined_backend,
             save_decode_cache,
+            max_local_chunks,
+            local_store_dtype,
+            local_pin_memory,
         )
 
     @staticmethod
@@ -95,6 +119,9 @@ class LMCacheEngineConfig:
         remote_serde = config.get("remote_serde", "torch")
         pipelined_backend = config.get("pipelined_backend", False)
         save_decode_cache = config.get("save_decode_cache", False)
+        max_local_chunks = config.get("max_local_chunks", None)
+        local_store_dtype = config.get("local_store_dtype", None)
+        local_pin_memory = config.get("local_pin_memory", False)
 
         match local_device:
             case "cpu" | "cuda" | None:
@@ -121,6 +148,9 @@ class LMCacheEngineConfig:
             remote_serde,
             pipelined_backend,
             save_decode_cache,
+            max_local_chunks,
+            local_store_dtype,
+            local_pin_memory,
         )
 
 
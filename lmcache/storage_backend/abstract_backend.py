@@ -66,6 +66,7 @@ class LMCBackendInterface(metaclass=abc.ABCMeta):
         self,
         keys_and_chunks: Iterable[Tuple[CacheEngineKey, torch.Tensor]],
         blocking=True,
+        prefix_keys: Optional[Iterable[CacheEngineKey]] = None,
     ) -> int:
         """
         Store the multiple keys and KV cache chunks into the cache engine in a
@@ -78,6 +79,9 @@ class LMCBackendInterface(metaclass=abc.ABCMeta):
                 format of a big tensor
             blocking: whether to block the call before the operation is 
                 completed
+            prefix_keys: the keys of the already stored chunks in front of
+                the given ones, if they are the chunks of one prefix.
+                Backends that evict chunks keep them.
 
         Returns:
             the number of chunks are stored
@@ -1,5 +1,5 @@
 import time
-from typing import Iterable, List, Optional, Union
+from typing import Iterable, List, Optional, Tuple, Union
 
 import torch
 
@@ -80,6 +80,18 @@ class LMCHybridBackend(LMCBackendInterface):
         self.local_store.put(key, value, blocking=True)
         self.remote_store.put(key, value, blocking)
 
+    def batched_put(
+        self,
+        keys_and_chunks: Iterable[Tuple[CacheEngineKey, torch.Tensor]],
+        blocking: bool = True,
+        prefix_keys: Optional[Iterable[CacheEngineKey]] = None,
+    ) -> int:
+        keys_and_chunks = list(keys_and_chunks)
+        self.local_store.batched_put(keys_and_chunks,
+                                     blocking=True,
+                                     prefix_keys=prefix_keys)
+        return self.remote_store.batched_put(keys_and_chunks, blocking)
+
     @_lmcache_nvtx_annotate
     def get(
         self,
@@ -97,12 +109,12 @@ class LMCHybridBackend(LMCBackendInterface):
         self,
         keys: Iterable[CacheEngineKey],
     ) -> Iterable[Optional[torch.Tensor]]:
-        ret: List[Optional[torch.Tensor]] = []
+        keys = list(keys)
+        ret: List[Optional[torch.Tensor]] = list(
+            self.local_store.batched_get(keys))
         remote_queries = []
         remote_query_idxs = []
-        for idx, key in enumerate(keys):
-            value = self.local_store.get(key)
-            ret.append(value)
+        for idx, (key, value) in enumerate(zip(keys, ret)):
             if value is None:
                 remote_queries.append(key)
                 remote_query_idxs.append(idx)
@@ -1,7 +1,7 @@
 import os
 import queue
 import threading
-from typing import Dict, Optional, Set, Tuple, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import torch
 from safetensors import safe_open
@@ -14,11 +14,86 @@ from lmcache.utils import CacheEngineKey, KVCache, _lmcache_nvtx_annotate
 
 logger = init_logger(__name__)
 
+# The dtypes that the local backend can keep the kv chunks in
+_LOCAL_STORE_DTYPES = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+# A kv chunk as kept by the local backend: (data, int8 scale or None,
+# original dtype)
+EncodedChunk = Tuple[torch.Tensor, Optional[torch.Tensor], torch.dtype]
+
+# (keys of the stored chunks in front of the batch, keys and kv chunks)
+PutBatch = Tuple[List[CacheEngineKey], List[Tuple[CacheEngineKey,
+                                                  torch.Tensor]]]
+
 
 class LocalBackendEndSignal:
     pass
 
 
+class ChunkLRUList:
+    """
+    Doubly linked list of chunk ids, ordered from the least recently used
+    (head) to the most recently used (tail).
+
+    The links are kept in two int lists indexed by chunk id (-1 means none),
+    so append/remove/touch are O(1) and do not create per-chunk objects.
+    """
+
+    def __init__(self):
+        self.prev: List[int] = []
+        self.next: List[int] = []
+        self.head = -1
+        self.tail = -1
+
+    def append(self, chunk_id: int) -> None:
+        """
+        Add the chunk id as the most recently used one
+        """
+        while len(self.prev) <= chunk_id:
+            self.prev.append(-1)
+            self.next.append(-1)
+        self.prev[chunk_id] = self.tail
+        self.next[chunk_id] = -1
+        if self.tail == -1:
+            self.head = chunk_id
+        else:
+            self.next[self.tail] = chunk_id
+        self.tail = chunk_id
+
+    def remove(self, chunk_id: int) -> None:
+        prev_id = self.prev[chunk_id]
+        next_id = self.next[chunk_id]
+        if prev_id == -1:
+            self.head = next_id
+        else:
+            self.next[prev_id] = next_id
+        if next_id == -1:
+            self.tail = prev_id
+        else:
+            self.prev[next_id] = prev_id
+
+    def touch(self, chunk_id: int) -> None:
+        """
+        Mark the chunk id as the most recently used one
+        """
+        if chunk_id != self.tail:
+            self.remove(chunk_id)
+            self.append(chunk_id)
+
+    def pop_lru(self) -> int:
+        """
+        Remove and return the least recently used chunk id
+        """
+        chunk_id = self.head
+        assert chunk_id != -1, "Cannot pop from an empty LRU list"
+        self.remove(chunk_id)
+        return chunk_id
+
+
 class LMCLocalBackend(LMCBackendInterface):
     """
     Cache engine for storing the KV cache of the tokens in the local cpu/gpu
@@ -30,24 +105,49 @@ class LMCLocalBackend(LMCBackendInterface):
         Throws:
             RuntimeError if the loaded configuration does not match the current
                 configuration
+            ValueError if the local store dtype is not supported or
+                max_local_chunks is not positive
         """
         super().__init__()
+        self.put_thread: Optional[threading.Thread] = None
 
         self.chunk_size = config.chunk_size
         self.config = config
-        self.dict: Dict[CacheEngineKey, torch.Tensor] = {}
+        # The chunks are stored in a list and addressed by a stable integer
+        # id, the dict only maps keys to ids
+        self.key_to_chunk_id: Dict[CacheEngineKey, int] = {}
+        self.chunks: List[EncodedChunk] = []
+        self.chunk_keys: List[CacheEngineKey] = []
         self.device = config.local_device
 
-        self.put_queue: queue.Queue[
-            Union[Tuple[CacheEngineKey, torch.Tensor],
-                  LocalBackendEndSignal]] = queue.Queue()
+        # Optionally keep the chunks in a smaller dtype. "int8" quantizes
+        # each head vector with its own scale, like the cachegen encoder.
+        self.store_dtype: Optional[torch.dtype] = None
+        if config.local_store_dtype is not None:
+            if config.local_store_dtype not in _LOCAL_STORE_DTYPES:
+                raise ValueError(f"Invalid local store dtype: "
+                                 f"{config.local_store_dtype}")
+            self.store_dtype = _LOCAL_STORE_DTYPES[config.local_store_dtype]
+
+        # Once max_chunks is reached, the least recently used chunk is
+        # evicted and its id is reused by the new chunk. Chunks of the prefix
+        # being stored are never evicted for it.
+        self.max_chunks = config.max_local_chunks
+        if self.max_chunks is not None and self.max_chunks < 1:
+            raise ValueError(f"Invalid max local chunks: {self.max_chunks}")
+        self.lru = ChunkLRUList()
+
+        self.put_queue: queue.Queue[Union[
+            PutBatch, LocalBackendEndSignal]] = queue.Queue()
         self.put_thread = threading.Thread(target=self.put_worker, args=())
         self.put_thread.start()
         self.update_lock = threading.Lock()
 
-        # FIXME(Jiayi): `use_pin_memory` and `dst_device` should be configged
-        # dynamically
-        self.use_pin_memory = False
+        # Optionally keep cpu chunks in pinned memory, so that the copies
+        # in both directions can be asynchronous
+        # FIXME(Jiayi): `dst_device` should be configged dynamically
+        self.use_pin_memory = (config.local_pin_memory and self.device == "cpu"
+                               and torch.cuda.is_available())
         logger.info(f"Using pinned cpu memory: {self.use_pin_memory}")
 
         self.dst_device = "cuda"
@@ -67,7 +167,7 @@ class LMCLocalBackend(LMCBackendInterface):
         Returns:
             True if the cache engine contains the key, False otherwise
         """
-        return key in self.dict
+        return key in self.key_to_chunk_id
 
     @_lmcache_nvtx_annotate
     def put_worker(self, ):
@@ -75,29 +175,174 @@ class LMCLocalBackend(LMCBackendInterface):
             item = self.put_queue.get()
             if isinstance(item, LocalBackendEndSignal):
                 break
-            key, value = item
+            prefix_keys, keys_and_chunks = item
             # with torch.cuda.stream(self.put_stream):
-            self.put_nonblocking(key, value)
+            self._put_batch(prefix_keys, keys_and_chunks)
+
+    def _touch_chunks(self, keys: List[CacheEngineKey]) -> None:
+        """
+        Mark the chunks as used back to front, so that the first chunk is
+        the most recently used one. The caller holds update_lock.
+        """
+        for key in reversed(keys):
+            chunk_id = self.key_to_chunk_id.get(key, None)
+            if chunk_id is not None:
+                self.lru.touch(chunk_id)
+
+    def _num_insertable(
+        self,
+        prefix_keys: List[CacheEngineKey],
+        keys: List[CacheEngineKey],
+    ) -> int:
+        """
+        Count the leading chunks of the keys that fit without evicting a
+        chunk of prefix_keys or keys. The later chunks of a prefix are
+        useless without the earlier ones, so the rest is dropped instead.
+        The caller holds update_lock.
+        """
+        if self.max_chunks is None:
+            return len(keys)
+        num_kept = len({
+            self.key_to_chunk_id[key]
+            for key in prefix_keys + keys if key in self.key_to_chunk_id
+        })
+        free_slots = self.max_chunks - num_kept
+        for idx, key in enumerate(keys):
+            if key in self.key_to_chunk_id:
+                continue
+            if free_slots == 0:
+                return idx
+            free_slots -= 1
+        return len(keys)
+
+    def _insert_chunks(
+        self,
+        prefix_keys: List[CacheEngineKey],
+        keys_and_chunks: List[Tuple[CacheEngineKey, EncodedChunk]],
+    ) -> int:
+        """
+        Insert the (already local) kv chunks of a prefix under a single lock,
+        reusing the chunk id if a key exists. prefix_keys are the keys of the
+        already stored chunks in front of them.
+
+        Whenever the backend is full, the least recently used chunk that is
+        not part of this prefix is evicted. The chunks are inserted back to
+        front and prefix_keys are touched last, so that the head of the
+        prefix is evicted last.
+
+        Returns:
+            the number of inserted chunks
+        """
+        self.update_lock.acquire()
+        keys = [key for key, _ in keys_and_chunks]
+        # Move the chunks of this prefix to the most recently used end, so
+        # that only chunks of other prefixes are evicted
+        self._touch_chunks(prefix_keys + keys)
+        num_chunks = self._num_insertable(prefix_keys, keys)
+        for key, kv_chunk_local in reversed(keys_and_chunks[:num_chunks]):
+            chunk_id = self.key_to_chunk_id.get(key, None)
+            if chunk_id is not None:
+                self.chunks[chunk_id] = kv_chunk_local
+                self.lru.touch(chunk_id)
+            elif (self.max_chunks is not None
+                  and len(self.chunks) >= self.max_chunks):
+                chunk_id = self.lru.pop_lru()
+                self.key_to_chunk_id.pop(self.chunk_keys[chunk_id])
+                self.key_to_chunk_id[key] = chunk_id
+                self.chunks[chunk_id] = kv_chunk_local
+                self.chunk_keys[chunk_id] = key
+                self.lru.append(chunk_id)
+            else:
+                chunk_id = len(self.chunks)
+                self.key_to_chunk_id[key] = chunk_id
+                self.chunks.append(kv_chunk_local)
+                self.chunk_keys.append(key)
+                self.lru.append(chunk_id)
+        self._touch_chunks(prefix_keys)
+        self.update_lock.release()
+        return num_chunks
+
+    def _encode(
+        self,
+        kv_chunk: torch.Tensor,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Convert the kv chunk to the store dtype, before it leaves its device
 
-    def put_nonblocking(self, key, kv_chunk):
+        Returns:
+            the converted chunk and the int8 scales (None if not quantized)
+        """
+        if self.store_dtype is None:
+            return kv_chunk, None
+        if self.store_dtype != torch.int8:
+            return kv_chunk.to(self.store_dtype), None
+        scale = torch.amax(torch.abs(kv_chunk), dim=-1, keepdim=True).float()
+        scale = scale.div_(127).clamp_(min=1e-8)
+        return torch.round(kv_chunk / scale).to(torch.int8), scale
+
+    def _decode(
+        self,
+        encoded_chunk: EncodedChunk,
+    ) -> torch.Tensor:
+        """
+        Move the stored chunk to dst_device and restore its original dtype
+        """
+        data, scale, dtype = encoded_chunk
+        data = data.to(self.dst_device, non_blocking=self.use_pin_memory)
+        if scale is not None:
+            scale = scale.to(self.dst_device, non_blocking=self.use_pin_memory)
+            return (data * scale).to(dtype)
+        return data.to(dtype)
+
+    def _to_local(self, tensor: torch.Tensor) -> torch.Tensor:
+        if not self.use_pin_memory:
+            return tensor.to(self.device)
+        if tensor.is_pinned():
+            return tensor
+        # Chunks from the gpu are copied straight into pinned memory
+        local = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        local.copy_(tensor, non_blocking=True)
+        return local
+
+    def _make_local(self, kv_chunk: torch.Tensor) -> EncodedChunk:
+        """
+        Encode the kv chunk and copy it to the local device. With pinned
+        memory the copy is asynchronous, call _sync_local() before the chunk
+        becomes visible to the readers.
+        """
+        data, scale = self._encode(kv_chunk)
+        if scale is not None:
+            scale = self._to_local(scale)
+        return self._to_local(data), scale, kv_chunk.dtype
+
+    def _sync_local(self) -> None:
         # TODO(Jiayi): torch.cuda.synchronize() needs to be removed
         # to enable actual async put
         # torch.cuda.synchronize() may disturb inference engine
         if self.use_pin_memory:
-            kv_chunk_local = kv_chunk.to(self.device, non_blocking=True)
             torch.cuda.synchronize()
-        else:
-            kv_chunk_local = kv_chunk.to(self.device)
+
+    def _put_batch(
+        self,
+        prefix_keys: List[CacheEngineKey],
+        keys_and_chunks: List[Tuple[CacheEngineKey, torch.Tensor]],
+    ) -> int:
         self.update_lock.acquire()
-        self.dict[key] = kv_chunk_local
+        num_chunks = self._num_insertable(prefix_keys,
+                                          [key for key, _ in keys_and_chunks])
         self.update_lock.release()
+        if num_chunks < len(keys_and_chunks):
+            logger.debug(f"Local backend is full, dropping the last "
+                         f"{len(keys_and_chunks) - num_chunks} chunks")
+
+        # Issue all the copies first and wait for them only once
+        local_chunks = [(key, self._make_local(kv_chunk))
+                        for key, kv_chunk in keys_and_chunks[:num_chunks]]
+        self._sync_local()
+        return self._insert_chunks(prefix_keys, local_chunks)
 
     def put_blocking(self, key, kv_chunk):
-        if self.use_pin_memory:
-            self.dict[key] = kv_chunk.to(self.device, non_blocking=True)
-            torch.cuda.synchronize()
-        else:
-            self.dict[key] = kv_chunk.to(self.device)
+        self._put_batch([], [(key, kv_chunk)])
 
     def put(
         self,
@@ -122,7 +367,49 @@ class LMCLocalBackend(LMCBackendInterface):
         if blocking:
             self.put_blocking(key, kv_chunk)
         else:
-            self.put_queue.put((key, kv_chunk))
+            self.put_queue.put(([], [(key, kv_chunk)]))
+
+    def batched_put(
+        self,
+        keys_and_chunks: Iterable[Tuple[CacheEngineKey, torch.Tensor]],
+        blocking: bool = True,
+        prefix_keys: Optional[Iterable[CacheEngineKey]] = None,
+    ) -> int:
+        """
+        Store the multiple keys and KV cache chunks into the cache engine.
+
+        The chunks are treated as one prefix: storing them never evicts one
+        of them or a chunk of prefix_keys. If they do not all fit, only the
+        leading ones are stored. The head of the prefix becomes the most
+        recently used chunk and is evicted last. In the blocking mode, all
+        chunks are moved to the local device first and then inserted in one
+        batch.
+
+        Returns:
+            the number of stored chunks, or of queued chunks in the
+            non-blocking mode
+        """
+        keys_and_chunks = list(keys_and_chunks)
+        prefix_key_list = [] if prefix_keys is None else list(prefix_keys)
+        if not blocking:
+            self.put_queue.put((prefix_key_list, keys_and_chunks))
+            return len(keys_and_chunks)
+        return self._put_batch(prefix_key_list, keys_and_chunks)
+
+    def _get_chunk(
+        self,
+        key: CacheEngineKey,
+        touch: bool = True,
+    ) -> Optional[EncodedChunk]:
+        self.update_lock.acquire()
+        chunk_id = self.key_to_chunk_id.get(key, None)
+        kv_chunk = None
+        if chunk_id is not None:
+            kv_chunk = self.chunks[chunk_id]
+            if touch:
+                self.lru.touch(chunk_id)
+        self.update_lock.release()
+        return kv_chunk
 
     @_lmcache_nvtx_annotate
     def get(
@@ -138,10 +425,32 @@ class LMCLocalBackend(LMCBackendInterface):
             the kv cache of the token chunk, in the format of nested tuples
             None if the key is not found
         """
-        kv_chunk = self.dict.get(key, None)
-        if kv_chunk is not None:
-            kv_chunk = kv_chunk.to(self.dst_device)
-        return kv_chunk
+        kv_chunk = self._get_chunk(key)
+        if kv_chunk is None:
+            return None
+        return self._decode(kv_chunk)
+
+    @_lmcache_nvtx_annotate
+    def batched_get(
+        self,
+        keys: Iterable[CacheEngineKey],
+    ) -> Iterable[Optional[torch.Tensor]]:
+        """
+        Retrieve the kv cache chunks by the given keys.
+
+        The chunks are marked as used back to front, so that the first
+        chunks of a prefix are the most recently used ones and are evicted
+        last.
+        """
+        keys = list(keys)
+        kv_chunks = [self._get_chunk(key, touch=False) for key in keys]
+        self.update_lock.acquire()
+        self._touch_chunks(keys)
+        self.update_lock.release()
+        return [
+            None if kv_chunk is None else self._decode(kv_chunk)
+            for kv_chunk in kv_chunks
+        ]
 
     def close(self):
         if self.put_thread is not None and self.put_thread.is_alive():
@@ -172,6 +481,7 @@ class LMCLocalDiskBackend(LMCBackendInterface):
                 configuration
         """
         super().__init__()
+        self.put_thread: Optional[threading.Thread] = None
 
         self.chunk_size = config.chunk_size
         self.config = config
@@ -183,6 +493,7 @@ class LMCLocalDiskBackend(LMCBackendInterface):
         if not os.path.exists(self.path):
             os.makedirs(self.path)
         self.existing_keys: Set[CacheEngineKey] = set()
+        self._load_existing_keys(self.path)
 
         # TODO(Jiayi): the following async put code is repeated in all backends
         # Please consider use a parent class that can be inherited by all
@@ -229,6 +540,36 @@ class LMCLocalDiskBackend(LMCBackendInterface):
         """
         return self.path + key.to_string().replace("/", "-") + ".pt"
 
+    def _load_existing_keys(self, path: str) -> None:
+        """
+        Register the chunks already saved under the path, e.g., by a
+        previous run.
+
+        Only the safetensors header of each file is read (the key is kept in
+        its metadata), the tensors are loaded lazily in get(). So the memory
+        used here does not depend on the size of the cache.
+
+        Files that cannot be read, e.g., truncated by a crashed save, are
+        skipped.
+        """
+        for filename in os.listdir(path):
+            if not filename.endswith(".pt"):
+                continue
+            try:
+                with safe_open(path + filename,
+                               framework="pt") as f:  # type: ignore
+                    metadata = f.metadata()
+                if metadata is None or "key" not in metadata:
+                    continue
+                key = CacheEngineKey.from_string(metadata["key"])
+            except Exception as e:
+                logger.warning(f"Skipping unreadable chunk file "
+                               f"{path + filename}: {e}")
+                continue
+            self.existing_keys.add(key)
+        logger.info(f"Found {len(self.existing_keys)} existing chunks in "
+                    f"{path}")
+
     @_lmcache_nvtx_annotate
     def put_worker(self, ):
         put_stream = torch.cuda.Stream()
@@ -248,7 +589,9 @@ class LMCLocalDiskBackend(LMCBackendInterface):
         logger.info(f"Saving cache to {self._key_to_path(key)}")
         # The following order matters of `save_file` and `update dictionary`
         # matters
-        save_file({"kv_chunk": kv_chunk}, self._key_to_path(key))
+        save_file({"kv_chunk": kv_chunk},
+                  self._key_to_path(key),
+                  metadata={"key": key.to_string()})
         self.update_lock.acquire()
         self.existing_keys.add(key)
         self.update_lock.release()
@@ -16,6 +16,7 @@ setup(
         "redis",
         "nvtx",
         "safetensors",
+        "blake3",
         "torchac_cuda >= 0.2.5",
     ],
     classifiers=[
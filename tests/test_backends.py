@@ -201,3 +201,112 @@ def test_restart(autorelease, lmserver_process):
         assert value.shape == retrieved.shape
         if config.remote_serde == "torch":
             assert (value == retrieved.to(value.device)).all()
+
+
+def test_local_lru_eviction(autorelease):
+    config = LMCacheEngineConfig.from_defaults(local_device="cpu",
+                                               remote_url=None,
+                                               max_local_chunks=4)
+    backend = autorelease(CreateStorageBackend(config, get_metadata()))
+
+    keys = [generate_random_key() for i in range(6)]
+    values = [torch.rand((16, 2, 16, 4, 16)) for i in range(6)]
+
+    # chunks of a batch are evicted from the back of the prefix first
+    backend.batched_put(zip(keys[:4], values[:4]))
+    backend.put(keys[4], values[4])
+    assert not backend.contains(keys[3])
+    assert all(backend.contains(key) for key in keys[:3])
+
+    # a retrieved chunk becomes the most recently used one
+    backend.batched_get(keys[:1])
+    backend.put(keys[5], values[5])
+    assert not backend.contains(keys[2])
+    assert all(backend.contains(key) for key in [keys[0], keys[1], keys[4]])
+    assert backend.contains(keys[5])
+
+    with pytest.raises(ValueError):
+        config = LMCacheEngineConfig.from_defaults(local_device="cpu",
+                                                   remote_url=None,
+                                                   max_local_chunks=0)
+        CreateStorageBackend(config, get_metadata())
+
+
+def test_local_lru_keeps_prefix(autorelease):
+    config = LMCacheEngineConfig.from_defaults(local_device="cpu",
+                                               remote_url=None,
+                                               max_local_chunks=3)
+    backend = autorelease(CreateStorageBackend(config, get_metadata()))
+
+    keys = [generate_random_key() for i in range(5)]
+    values = [torch.rand((16, 2, 16, 4, 16)) for i in range(5)]
+
+    # only the leading chunks of a prefix that fit are stored
+    assert backend.batched_put(zip(keys, values)) == 3
+    assert [backend.contains(key) for key in keys] == [True] * 3 + [False] * 2
+
+    # storing the rest of the prefix never evicts its head
+    assert backend.batched_put(zip(keys[3:], values[3:]),
+                               prefix_keys=keys[:3]) == 0
+    assert [backend.contains(key) for key in keys] == [True] * 3 + [False] * 2
+
+    # another prefix evicts the tail of this one first
+    other_key = generate_random_key()
+    backend.put(other_key, values[0])
+    assert [backend.contains(key) for key in keys] == [True] * 2 + [False] * 3
+    assert backend.contains(other_key)
+
+
+@pytest.mark.parametrize("store_dtype", ["float16", "bfloat16", "int8"])
+def test_local_store_dtype(store_dtype, autorelease):
+    config = LMCacheEngineConfig.from_defaults(local_device="cpu",
+                                               remote_url=None,
+                                               local_store_dtype=store_dtype)
+    backend = autorelease(CreateStorageBackend(config, get_metadata()))
+
+    key = generate_random_key()
+    value = torch.rand((16, 2, 16, 4, 128), dtype=torch.float32) - 0.5
+    backend.put(key, value)
+
+    retrieved = backend.get(key)
+    assert retrieved.dtype == value.dtype
+    assert retrieved.shape == value.shape
+    assert torch.allclose(retrieved.to(value.device), value, atol=1e-2)
+
+
+def test_local_pin_memory(autorelease):
+    config = LMCacheEngineConfig.from_defaults(local_device="cpu",
+                                               remote_url=None,
+                                               local_pin_memory=True)
+    backend = autorelease(CreateStorageBackend(config, get_metadata()))
+
+    keys = [generate_random_key() for i in range(4)]
+    values = [torch.rand((16, 2, 16, 4, 16), device="cuda") for i in range(4)]
+    backend.batched_put(zip(keys, values))
+
+    for key, value in zip(keys, values):
+        data, _, _ = backend.chunks[backend.key_to_chunk_id[key]]
+        assert data.is_pinned()
+        assert torch.equal(backend.get(key), value)
+
+
+def test_disk_restart(autorelease, tmp_path):
+    config = LMCacheEngineConfig.from_defaults(local_device=f"{tmp_path}/",
+                                               remote_url=None)
+    backend = autorelease(CreateStorageBackend(config, get_metadata()))
+
+    N = 10
+    keys = [generate_random_key() for i in range(N)]
+    random_tensors = [torch.rand((16, 2, 16, 4, 16)) for i in range(N)]
+    for key, value in zip(keys, random_tensors):
+        backend.put(key, value)
+
+    # a truncated file, e.g., from a crashed save, is skipped
+    (tmp_path / "truncated.pt").write_bytes(b"0123456789")
+
+    # a new backend on the same path should find the saved chunks
+    new_backend = autorelease(CreateStorageBackend(config, get_metadata()))
+    for key, value in zip(keys, random_tensors):
+        assert new_backend.contains(key)
+        retrieved = new_backend.get(key)
+        assert torch.equal(value, retrieved.to(value.device))
@@ -302,3 +302,59 @@ def test_builder(autorelease):
 
     with pytest.raises(ValueError):
         LMCacheEngineBuilder.get_or_create(instance_id, cfg2, dumb_metadata())
+
+
+@pytest.mark.parametrize("chunk_size", [128, 256])
+def test_prefix_hash_memo(chunk_size, autorelease):
+    cfg = LMCacheEngineConfig.from_legacy(chunk_size=chunk_size, backend="cpu")
+    engine = autorelease(LMCacheEngine(cfg, dumb_metadata()))
+
+    tokens = generate_tokens(1000, "cpu")
+    longer_tokens = torch.cat([tokens, generate_tokens(500, "cpu")])
+    diverged_tokens = longer_tokens.clone()
+    diverged_tokens[700] += 1
+
+    for t in [tokens, longer_tokens, tokens[:300], diverged_tokens, tokens]:
+        fresh_engine = autorelease(LMCacheEngine(cfg, dumb_metadata()))
+        assert engine._prefix_hash(t) == fresh_engine._prefix_hash(t)
+        assert engine._prefix_hash(t, 2) == fresh_engine._prefix_hash(t, 2)
+
+
+def test_store_keeps_shared_prefix(autorelease):
+    device = "cuda"
+    fmt = "vllm"
+    cfg = LMCacheEngineConfig.from_legacy(chunk_size=16,
+                                          backend="cpu",
+                                          max_local_chunks=10)
+    engine = autorelease(LMCacheEngine(cfg, dumb_metadata(fmt)))
+
+    # 8 chunks, and 8 chunks sharing the first 3 chunks with them
+    tokens = generate_tokens(128, device)
+    kv_cache = generate_kv_cache(128, fmt, device)
+    shared_kv_cache = tuple((k[:48], v[:48]) for k, v in kv_cache)
+    new_tokens = torch.cat([tokens[:48], generate_tokens(80, device)])
+    new_kv_cache = concatenate_kv_caches(
+        [shared_kv_cache, generate_kv_cache(80, fmt, device)], fmt)
+    engine.store(tokens, kv_cache)
+    engine.store(new_tokens, new_kv_cache)
+
+    # evicting 3 more chunks takes the tail of the second prefix, not the
+    # shared head that was skipped when storing it
+    engine.store(generate_tokens(32, device),
+                 generate_kv_cache(32, fmt, device))
+    engine.store(generate_tokens(16, device),
+                 generate_kv_cache(16, fmt, device))
+    chunk_hashes = engine._prefix_hash(new_tokens)
+    assert [
+        engine.engine_.contains(engine._make_key(chunk_hash, fmt))
+        for chunk_hash in chunk_hashes
+    ] == [True] * 7 + [False]
+    retrieved_cache, ret_mask = engine.retrieve(new_tokens)
+    assert torch.sum(ret_mask) == 112
+    check_kv_cache_equal(retrieved_cache, new_kv_cache, 112, fmt)
+
+    # storing again completes the prefix
+    engine.store(new_tokens, new_kv_cache)
+    retrieved_cache, ret_mask = engine.retrieve(new_tokens)
+    assert torch.sum(ret_mask) == 128
+    check_kv_cache_equal(retrieved_cache, new_kv_cache, 128, fmt)